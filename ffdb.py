@@ -7,16 +7,22 @@ which employs a single container file.
 
 by Giuseppe Insana, 2020
 """
+import io
 import os
 import re
 import sys
 import time
 import zlib
 from math import ceil
+from functools import lru_cache
+from hashlib import pbkdf2_hmac
 from heapq import merge #alternative mergesort
-from Cryptodome.Cipher import AES
-from Cryptodome.Protocol import KDF
-from Cryptodome import Random
+try: #zlib-ng, if installed, inflates faster; its raw deflate streams are compatible
+    from zlib_ng import zlib_ng as inflate_zlib
+except ImportError:
+    inflate_zlib = zlib
+#NOTE: Cryptodome is imported within the cipher functions, to keep startup fast
+#      for the scripts (or modes) which never encrypt or decrypt
 
 # pylint: disable=C0103,R0912,R0915,W0603
 VERSION = '2.5.6'
@@ -51,6 +57,8 @@ GZTOOL_EXE = None
 #buffer size used by io operations
 #BUFFERSIZE = 8192
 BUFFERSIZE = 1048576
+#maximum buffer size used when copying large pieces of files, scaled from BUFFERSIZE
+MAXBUFFERSIZE = 8388608
 
 ##CONSTANTS:
 
@@ -63,6 +71,11 @@ RETERMINATOR = re.compile(r'^-$')
 
 B64_CHARS = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ{}'
 B64_INDEX = dict((char, pos) for pos, char in enumerate(tuple(B64_CHARS)))
+B64_INDEX.update((ord(char), pos) for char, pos in tuple(B64_INDEX.items())) #to decode bytes
+B64_PAIRS = tuple(char1 + char2 for char1 in B64_CHARS for char2 in B64_CHARS) #12 bits each
+#translate base64 digits into bytes sorting as their values, to compare encoded numbers
+#of the same length without decoding them
+B64_SORTABLE = bytes.maketrans(B64_CHARS.encode(), bytes(range(64)))
 
 
 def calculate_chunknum(filename, blocksize):
@@ -160,35 +173,35 @@ def chunk_of_lines(fp, filesize, blocksize, block):
         yield fp.readline()
 
 
+def batch(iterable, batchsize=1):
+    """
+    split iterable in constant-size chunks
+    """
+    length = len(iterable)
+    for index in range(0, length, batchsize):
+        yield iterable[index:min(index + batchsize, length)]
+
+
 def int_to_b64(number):
     """
     convert a decimal integer to a base64encoded number
     """
-    if number == 0:
-        return '0'
+    if number < 64:
+        return B64_CHARS[number]
     string = ''
-    while number:
-        string = B64_CHARS[number % 64] + string
-        number //= 64
-        #~13% slower:
-        #number, remainder = divmod(number, 64)
-        #string = B64_CHARS[remainder] + string
-    return string
+    while number: #two characters at a time
+        string = B64_PAIRS[number & 4095] + string
+        number >>= 12
+    return string.lstrip('0')
 
 
 def b64_to_int(string):
     """
-    convert a base64encoded number to decimal integer
+    convert a base64encoded number (str or bytes) to decimal integer
     """
-    strlen = len(string)
     number = 0
-    index = 0
     for char in string:
-        index += 1
-        power = strlen - index
-        number += B64_INDEX[char] * (64 ** power)
-        #~20% slower:
-        # number += B64_CHARS.index(char) * (64 ** power)
+        number = (number << 6) | B64_INDEX[char]
     return number
 
 
@@ -255,7 +268,9 @@ def inflate(data):
     """
     decompress a byte object
     """
-    decompress = zlib.decompressobj(
+    #zlib-ng is used only here: zlib is kept for deflate, for compressed flatfiles
+    #to be identical whichever is installed
+    decompress = inflate_zlib.decompressobj(
         -zlib.MAX_WBITS
     )
     inflated = decompress.decompress(data)
@@ -299,23 +314,41 @@ def merge_indexes(index1_filename, index2_filename, pos_offset,
     """
     merge two index files into one outfile, shifting the second one of given offset
     returns number of identifiers from the second index
+    index2_filename, pos_offset and tempfile can also be lists, to merge
+    several new indexes at once, each shifted of its own offset
     """
-    if tempfile is None: #read second index into array, then merge
-        new_identifiers = shift_index(index2_filename,
-                                      pos_offset,
-                                      index_type)
+    if isinstance(index2_filename, str):
+        index2_filenames = [index2_filename]
+        pos_offsets = [pos_offset]
+        tempfiles = None if tempfile is None else [tempfile]
+    else:
+        index2_filenames = index2_filename
+        pos_offsets = pos_offset
+        tempfiles = tempfile
+    new_identifiers_count = 0
+    if tempfiles is None: #read second index into array, then merge
+        new_identifiers = list()
+        for newindex_filename, new_offset in zip(index2_filenames, pos_offsets):
+            new_identifiers.extend(shift_index(newindex_filename,
+                                               new_offset,
+                                               index_type))
+        if len(index2_filenames) > 1:
+            new_identifiers.sort() #sort once all new indexes have been read
         new_identifiers_count = len(new_identifiers)
         #faster than heap_mergesort if len(new_identifiers) is small
         mergesort_file_array(index1_filename, new_identifiers, outfile)
         #slower but with good performance no matter which size:
         #heap_mergesort_file_array(index1_filename, new_identifiers, outfile) #ALT
-    else: #use a temporary file to shift the second index, then merge files
-        new_identifiers_count = shift_index_file(index2_filename,
-                                                 pos_offset,
-                                                 tempfile,
-                                                 index_type)
-        mergesort_files([index1_filename, tempfile], outfile)
-        os.remove(tempfile)
+    else: #use temporary files to shift the second indexes, then merge files
+        for newindex_filename, new_offset, new_tempfile in zip(index2_filenames, pos_offsets,
+                                                               tempfiles):
+            new_identifiers_count += shift_index_file(newindex_filename,
+                                                      new_offset,
+                                                      new_tempfile,
+                                                      index_type)
+        mergesort_files([index1_filename] + tempfiles, outfile)
+        for new_tempfile in tempfiles:
+            os.remove(new_tempfile)
     return new_identifiers_count
 
 
@@ -545,6 +578,11 @@ def init_cipher(key, iv):
     """
     initialize and return a new cipher
     """
+    from Cryptodome.Cipher import AES
+    #CFB with 8 bit segments: changing mode or segment size would make existing
+    #encrypted flatfiles unreadable; Cryptodome already uses AES-NI where available
+    #the returned cipher owns its key schedule and cannot be rewound: a new one is
+    #needed for every iv and for switching between encryption and decryption
     return AES.new(key, AES.MODE_CFB, iv)
 
 
@@ -552,14 +590,27 @@ def generate_iv():
     """
     generate and return a new iv
     """
+    from Cryptodome.Cipher import AES
+    from Cryptodome import Random
     return Random.new().read(AES.block_size)
 
 
+@lru_cache(maxsize=16)
+def _derive_longest_key(passphrase, salt):
+    """
+    derive from passphrase a key of the longest bytesize (aes256)
+    PBKDF2 keys of smaller bytesizes are prefixes of it
+    """
+    #same as Cryptodome's PBKDF2 defaults (HMAC-SHA1, 1000 iterations, latin-1 passphrase)
+    #used so far: changing any of these would make existing encrypted flatfiles unreadable
+    return pbkdf2_hmac('sha1', passphrase.encode('latin-1'), salt, 1000, 32)
+
+
 def derive_key(passphrase, keysize):
     """
     derive key of desired bytesize from passphrase
     """
-    key = KDF.PBKDF2(passphrase, SALT, keysize)
+    key = _derive_longest_key(passphrase, SALT)[:keysize]
     if len(key) != keysize:
         msg = "Attention! Something has gone wrong when deriving key from passphrase!"
         raise RuntimeError(msg)
@@ -643,6 +694,17 @@ def delete_file_if_exists(filename, path=None):
             pass
 
 
+def open_for_appending(filename):
+    """
+    open a file in binary mode for writing at its end, creating it if needed
+    not using O_APPEND (as 'ab' would), which in-kernel copies refuse to write to
+    """
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fh = open(os.open(filename, flags, 0o666), 'wb')
+    fh.seek(0, os.SEEK_END)
+    return fh
+
+
 def close_subfiles(fhlist):
     """
     close the filehandles for the temporary sub-files
@@ -651,29 +713,43 @@ def close_subfiles(fhlist):
         fh.close()
 
 
-def print_subfiles(filenames, fh=None, offset=0):
+def print_subfiles(filenames, fh=None, offset=0, delete=False):
     """
     read and print a series of temporary sub-files writing them sequentially
     to a given output filehandle or print them to stdout
+    optionally delete each sub-file as soon as it has been written
     """
     mode = 'rb'
+    out_offset = None
     if fh is None:
         fh = sys.stdout #print to stdout if no fh given
         mode = 'r'
+    else:
+        fh.flush() #sub-files are written straight to the file descriptor
+        if fh.seekable(): #keep track of position, for later writes through fh
+            out_offset = fh.tell()
     for filename in filenames:
         with open(filename, mode) as infile:
-            ##straight, unbuffered, will read whole file in memory
-            #fh.write(infile.read())
-            ##buffered:
-            filesize = os.path.getsize(filename)
-            if offset > 0:
-                infile.seek(offset)
-                filesize -= offset
-            blockcount, remainder = divmod(filesize, BUFFERSIZE)
-            for _ in range(blockcount):
-                buffered = infile.read(BUFFERSIZE)
-                fh.write(buffered)
-            fh.write(infile.read(remainder))
+            filesize = os.fstat(infile.fileno()).st_size - offset
+            if mode == 'rb': #in-kernel copy, where available
+                copied = kernel_readwrite(infile.fileno(), fh.fileno(), offset, filesize,
+                                          out_offset)
+                if out_offset is not None:
+                    out_offset += copied
+                    fh.seek(out_offset)
+            else:
+                ##straight, unbuffered, will read whole file in memory
+                #fh.write(infile.read())
+                ##buffered:
+                if offset > 0:
+                    infile.seek(offset)
+                blockcount, remainder = divmod(filesize, BUFFERSIZE)
+                for _ in range(blockcount):
+                    buffered = infile.read(BUFFERSIZE)
+                    fh.write(buffered)
+                fh.write(infile.read(remainder))
+        if delete: #reclaim space right away
+            os.remove(filename)
 
 
 def shift_index(index_filename, offset, index_type):
@@ -684,6 +760,7 @@ def shift_index(index_filename, offset, index_type):
     identifiers = list()
     with open(index_filename, 'r', 1) as indexfh: #using line buffering
         for line in indexfh:
+            line = line.rstrip("\n")
             columns = line.split(FIELDSEPARATOR)
             position = columns[1] #2nd column of index file is position
             if index_type in ("+", "."): #entry sizes and iv stored
@@ -703,34 +780,29 @@ def shift_index_file(index_filename, offset, outfile, index_type):
     """
     shift positions in index file by given offset creating outfile
     """
-    buffered = ""
+    #index is processed in binary mode, a block of lines at a time
+    fieldseparator = FIELDSEPARATOR.encode()
+    index_type_sep = index_type.encode()
+    buffered = bytearray() #output buffer, reused for all blocks
     shifted_count = 0
-    buflines = 100 #write every 100 lines
-    bufcounter = 0
-    with open(index_filename, 'r', 1) as indexfh: #using line buffering
-        with open(outfile, 'w') as outfh:
-            for line in indexfh:
-                line = line.rstrip("\n")
-                columns = line.split(FIELDSEPARATOR)
-                position = columns[1] #2nd column of index file is position
-                if index_type in ("+", "."): #entry sizes and iv stored
-                    posmatch = REESIVN.match(position)
-                elif index_type in (":", "-"): #entry sizes stored, no iv
-                    posmatch = REES.match(position)
-                position, remaining = posmatch.groups()
-                position = b64_to_int(position)
-                if bufcounter > buflines: #write to outfile and reset buffer
-                    outfh.write(buffered)
-                    shifted_count += bufcounter
-                    bufcounter = 0
-                    buffered = ""
-                columns[1] = "{}{}{}".format(int_to_b64(position + offset),
-                                             index_type,
-                                             remaining)
-                buffered += FIELDSEPARATOR.join(columns) + "\n"
-                bufcounter += 1
-            shifted_count += bufcounter
-            outfh.write(buffered) #last block
+    with open(index_filename, 'rb') as indexfh:
+        with open(outfile, 'wb') as outfh:
+            while True:
+                lines = indexfh.readlines(BUFFERSIZE)
+                if not lines:
+                    break
+                if lines[-1][-1:] != b"\n": #last line of index without newline
+                    lines[-1] += b"\n"
+                for line in lines:
+                    #the index type character separates position from the rest (size, iv)
+                    identifier, _, posfield = line.partition(fieldseparator)
+                    position, _, remaining = posfield.partition(index_type_sep)
+                    buffered += identifier + fieldseparator + \
+                        int_to_b64(b64_to_int(position) + offset).encode() + \
+                        index_type_sep + remaining
+                outfh.write(buffered)
+                buffered.clear()
+                shifted_count += len(lines)
     return shifted_count
 
 
@@ -882,6 +954,89 @@ def buffered_readwrite(inputfile, outputfile, startpos, size):
             outfh.flush()
 
 
+def _copy_file_range(in_fd, out_fd, offset, size, out_offset=None):
+    """
+    in-kernel copy between regular files (linux >= 4.5)
+    """
+    return os.copy_file_range(in_fd, out_fd, size, offset, out_offset)
+
+
+def _sendfile(in_fd, out_fd, offset, size, out_offset=None):
+    """
+    in-kernel copy from a regular file (towards any fd on linux)
+    """
+    if out_offset is not None:
+        os.lseek(out_fd, out_offset, os.SEEK_SET)
+    return os.sendfile(out_fd, in_fd, offset, size)
+
+
+#in-kernel copy calls available on this platform, in order of preference
+KERNEL_COPY_CALLS = list()
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPY_CALLS.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    KERNEL_COPY_CALLS.append(_sendfile)
+
+
+def kernel_readwrite(in_fd, out_fd, offset, size, out_offset=None):
+    """
+    copy a piece of given size from given position of input fd to output fd
+    in-kernel via copy_file_range or sendfile where available,
+    with buffered read/write otherwise
+    optionally write at given position of output fd, rather than at its current one
+    returns number of bytes copied
+    """
+    copied = 0
+    for kernel_copy in KERNEL_COPY_CALLS:
+        try:
+            while copied < size:
+                done = kernel_copy(in_fd, out_fd, offset + copied, size - copied,
+                                   None if out_offset is None else out_offset + copied)
+                if done == 0: #reached end of input
+                    return copied
+                copied += done
+            return copied
+        except OSError: #unsupported for given fds, e.g. pipes, appending or cross-filesystem
+            pass
+    os.lseek(in_fd, offset + copied, os.SEEK_SET)
+    if out_offset is not None:
+        os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+    #a single buffer, sized on the piece to copy, is allocated and read into
+    buffersize = min(max(BUFFERSIZE, (size - copied) // 64), MAXBUFFERSIZE, size - copied)
+    buffered = memoryview(bytearray(buffersize))
+    inputfh = io.FileIO(in_fd, closefd=False) #readinto() is portable, os.readv() unix only
+    while copied < size:
+        readsize = inputfh.readinto(buffered[:min(buffersize, size - copied)])
+        if readsize == 0: #reached end of input
+            break
+        written = 0
+        while written < readsize: #write() could be partial on pipes
+            written += os.write(out_fd, buffered[written:readsize])
+        copied += written
+    return copied
+
+
+def drop_page_cache(fd, sync=False):
+    """
+    advise the kernel that the cached pages of given fd will not be needed again
+    optionally sync to disk first, since only clean pages can be dropped
+    """
+    if not hasattr(os, 'posix_fadvise'): #not available on all platforms
+        return
+    if sync:
+        os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def advise_sequential(fd):
+    """
+    advise the kernel that given fd will be read sequentially, for a more aggressive read-ahead
+    """
+    if not hasattr(os, 'posix_fadvise'): #not available on all platforms
+        return
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
 def check_iofiles(read_filenames, write_filenames):
     """
     check for ability to open input/output filenames
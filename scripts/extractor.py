@@ -29,8 +29,8 @@ from requests import get #for remote flatfiles via http
 #NECESSARY IMPORTS
 from ffdb import eprint, inflate, derive_key, check_index, \
     delete_files, delete_file_if_exists, REES, REESIV, GZTOOL_EXE, TEMPDIR, \
-    init_cipher, check_iofiles, b64_to_int, \
-    calculate_chunknum, calculate_blocksize, chunk_of_lines, siprefix2num, \
+    init_cipher, check_iofiles, b64_to_int, open_for_appending, \
+    calculate_chunknum, calculate_blocksize, chunk_of_lines, batch, siprefix2num, \
     read_from_size, print_subfiles, close_subfiles, elapsed_time, int_to_b64, \
     get_position_first, get_position_last, \
     get_position_checksum_first, get_position_checksum_last, \
@@ -70,15 +70,6 @@ def unzip(iterable):
     return zip(*iterable)
 
 
-def batch(iterable, batchsize=1):
-    """
-    split iterable in constant-size chunks
-    """
-    length = len(iterable)
-    for index in range(0, length, batchsize):
-        yield iterable[index:min(index + batchsize, length)]
-
-
 def find_chunkstart_size_common(gzscheme):
     """
     use u2c_map to calculate start and size of compressed blocks to fetch in order to
@@ -153,7 +144,7 @@ def gztool_retrieve_and_append_gzchunk(chunkstart, chunksize, gzchunk_file,
     extend given chunk retrieving remote compressed data and appending to it
     optionally rename it to newname to store in cache
     """
-    with open(gzchunk_file, 'ab') as CHUNKFH: #append, binary
+    with open_for_appending(gzchunk_file) as CHUNKFH: #append, binary
         if adjacent_start is not None and os.path.isfile(gzchunk_adjacent_file):
             if args.threads != 1:
                 open(gzchunk_adjacent_file+"l", 'a').close() #create lock file
@@ -194,7 +185,7 @@ def gztool_retrieve_and_prepend_gzchunk(chunkstart, chunksize,
     else:
         #eprint(" |-- downloading {} bytes for gzchunk cache".format(chunksize)) #debug
         gztool_init_new_zero_file(chunkstart - 1, temp_dl_file)
-        with open(temp_dl_file, 'ab') as CHUNKFH: #append, binary
+        with open_for_appending(temp_dl_file) as CHUNKFH: #append, binary
             CHUNKFH.write(retrieve_from_size(args.flatfile, chunkstart - 1, chunksize + 1))
             print_subfiles([gzchunk_file], CHUNKFH, offset=offset)
     if filename_final is not None and not os.path.exists(filename_final):
@@ -219,7 +210,7 @@ def gzchunks_merge_adjacent_common(gzscheme):
             offset = 0
         else: #gztool
             offset = gz_block_startpos(otherstart) + 1
-        with open(gzchunk_file, 'ab') as CHUNKFH:
+        with open_for_appending(gzchunk_file) as CHUNKFH:
             print_subfiles([gzchunk_file_other], fh=CHUNKFH, offset=offset)
         delete_files([gzchunk_file_other])
         os.rename(gzchunk_file, gzchunk_file_newname)
@@ -249,7 +240,7 @@ def gzchunks_merge_overlapping_common(gzscheme):
             offset = gz_block_startpos(otherstart) #initial zeros of second chunk
             offset += gz_block_endpos(thisend) - gz_block_startpos(otherstart) #overlap portion
             #append to gzchunk_file the content of gzchunk_file_other skipping initial zeros and overlap part
-            with open(gzchunk_file, 'ab') as CHUNKFH:
+            with open_for_appending(gzchunk_file) as CHUNKFH:
                 print_subfiles([gzchunk_file_other], fh=CHUNKFH, offset=offset)
         delete_files([gzchunk_file_other])
         os.rename(gzchunk_file, gzchunk_file_newname)
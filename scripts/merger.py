@@ -11,11 +11,18 @@ by Giuseppe Insana, 2020
 #IMPORTS:
 import os
 import sys
+import mmap
+import atexit
 import argparse
-from random import randint
-from shutil import copyfile
+import tempfile
+from shutil import copyfile, which
+from subprocess import run, Popen, PIPE, DEVNULL #for compression via gzip and gztool
 from ffdb import eprint, check_index, delete_files, GZTOOL_EXE, \
-    merge_indexes, TEMPDIR, BUFFERSIZE
+    merge_indexes, shift_index, kernel_readwrite, drop_page_cache, open_for_appending, TEMPDIR
+
+#CUSTOMIZATIONS:
+#addenda smaller than this will be memory-mapped and appended with a single write
+MMAPMAXSIZE = 2 << 30 #2 GiB
 
 #CONSTANTS
 PROGNAME = "merger.py"
@@ -24,19 +31,30 @@ AUTHOR = "Giuseppe Insana"
 args = None
 
 
-def check_index_compatibility(indexfile1, indexfile2):
+def read_first_line(filename):
     """
-    will check if old and new indexes are of same type
+    return the first line of a file, reading a single block
+    without setting up buffered text io
     """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        buffered = os.read(fd, 4096) #index lines are much shorter than this
+    finally:
+        os.close(fd)
+    newline_pos = buffered.find(b'\n')
+    if newline_pos != -1:
+        buffered = buffered[:newline_pos + 1]
+    return buffered.decode()
 
-    with open(indexfile1, 'r', 1) as indexfh:
-        line1 = indexfh.readline() #first line of index
 
+def check_index_compatibility(indexfile1, indexfile2):
+    """
+    will check if old and new indexes are of same type
+    """
+    line1 = read_first_line(indexfile1) #first line of index
     index_type1, cipher1, keysize1, has_checksum1 = check_index(line1)
 
-    with open(indexfile2, 'r', 1) as indexfh:
-        line2 = indexfh.readline() #first line of index
-
+    line2 = read_first_line(indexfile2) #first line of index
     index_type2, cipher2, keysize2, has_checksum2 = check_index(line2)
 
     if index_type1 != index_type2 or cipher1 != cipher2 or keysize1 != keysize2:
@@ -53,6 +71,32 @@ def check_index_compatibility(indexfile1, indexfile2):
     args.index_type = index_type1
 
 
+def merge_indexes_small(index_filename, newindex_filenames, offsets, outindex_filename):
+    """
+    merge small new indexes into the original index, writing outindex
+    the new indexes are shifted in memory, then interleaved with the lines
+    of the original index while streaming through it
+    returns number of identifiers from the new indexes
+    """
+    new_identifiers = list()
+    for newindex, offset in zip(newindex_filenames, offsets):
+        new_identifiers.extend(shift_index(newindex, offset, args.index_type))
+    new_identifiers.sort()
+    new_count = len(new_identifiers)
+
+    new_cursor = 0 #next new identifier to be written
+    with open(outindex_filename, 'w') as outfh:
+        with open(index_filename, 'r') as indexfh:
+            for line in indexfh:
+                while new_cursor < new_count and \
+                        new_identifiers[new_cursor] <= line:
+                    outfh.write(new_identifiers[new_cursor])
+                    new_cursor += 1
+                outfh.write(line)
+        outfh.writelines(new_identifiers[new_cursor:]) #if some left in the end, append
+    return new_count
+
+
 def uncompress_file(filename):
     """
     uncompress given filename
@@ -61,43 +105,84 @@ def uncompress_file(filename):
     return filename
 
 
-def compress_file(filename, create_gzindex=None):
+def compress_file(filenames, outfilename, create_gzindex=None):
     """
-    compress given filename
+    compress the concatenation of given filenames into outfilename.gz
+    streaming them through the compressor in a single sequential pass
     optionally create gzindex
-    return name of the uncompressed file
+    return name of the compressed file
     """
+    gz_filename = outfilename + ".gz"
+    gzindex_filename = gz_filename + ".gzi"
+    with open(gz_filename, 'wb') as gzfh:
+        compressor_pipe = Popen(args.compressor_call, stdin=PIPE, stdout=gzfh)
+        try:
+            for filename in filenames:
+                with open(filename, 'rb') as inputfh:
+                    in_fd = inputfh.fileno()
+                    kernel_readwrite(in_fd, compressor_pipe.stdin.fileno(),
+                                     0, os.fstat(in_fd).st_size)
+        except BrokenPipeError: #compressor died: its exit status is checked below
+            pass
+        compressor_pipe.stdin.close()
+        compressor_failed = compressor_pipe.wait() != 0
+    if compressor_failed:
+        eprint("    => ERROR: problems compressing into '{}'".format(gz_filename))
+        delete_files([gz_filename]) #do not leave a partial compressed file behind
+        sys.exit(1)
     if create_gzindex is not None:
-        #open pipe to call external gztool
-        pass
-    return filename
+        #call external gztool to index the compressed flatfile
+        gztool_call = [GZTOOL_EXE, '-i', '-I', gzindex_filename, gz_filename]
+        result = run(gztool_call, stdout=DEVNULL, stderr=PIPE)
+        if result.returncode != 0:
+            eprint("    => ERROR: problems creating gzindex for '{}'".format(gz_filename))
+            eprint("    => {}".format(result.stderr.decode()))
+            delete_files([gz_filename, gzindex_filename])
+            sys.exit(1)
+    return gz_filename
 
 
-def concatenate_into(filename, addenda, outfilename):
+def concatenate_into(filename, addenda_filenames, outfilename, dropcache=False):
     """
     first copy original file to a new file
-    then append content of addenda file at the end of the new file
+    then append content of addenda files at the end of the new file
     """
     copyfile(filename, outfilename)
     #append_to(outfilename, addenda) #reads the whole file in memory
-    append_to_buffered(outfilename, addenda)
+    with open_for_appending(outfilename) as outfh:
+        append_to_buffered(outfh, addenda_filenames, dropcache)
 
 
-def append_to_buffered(filename, addenda):
+def append_to_buffered(outfh, addenda_filenames, dropcache=False):
     """
-    append addenda file at the end of the given file, using buffered read/write
+    append addenda files, in the given order, to the given file opened at its end
+    (see open_for_appending: with O_APPEND in-kernel copies would fail)
+    memory-mapping smaller addenda, copying larger ones in-kernel
+    optionally drop the written pages from the OS page cache afterwards
     """
-    with open(addenda, 'rb') as inputfh:
-        with open(filename, 'ab') as outfh:
-            ##straight, unbuffered, will read whole file in memory:
-            #outfh.write(inputfh.read())
-            ##buffered:
-            blockcount, remainder = divmod(os.path.getsize(addenda), BUFFERSIZE)
-            for _ in range(blockcount):
-                buffered = inputfh.read(BUFFERSIZE)
-                outfh.write(buffered)
-            outfh.write(inputfh.read(remainder))
-            outfh.flush()
+    #open all addenda upfront, to fail before anything gets appended
+    inputfhs = [open(addenda, 'rb') for addenda in addenda_filenames]
+    for inputfh in inputfhs:
+        ##straight, unbuffered, will read whole file in memory:
+        #outfh.write(inputfh.read())
+        addenda_size = os.fstat(inputfh.fileno()).st_size
+        if 0 < addenda_size < MMAPMAXSIZE: #cannot mmap empty files
+            ##memory-mapped, written straight from the mapped pages:
+            with mmap.mmap(inputfh.fileno(), 0, access=mmap.ACCESS_READ) as addenda_map:
+                outfh.write(addenda_map)
+        else:
+            ##in-kernel, or buffered where not available:
+            outfh.flush() #anything written so far should precede the addenda
+            out_offset = outfh.tell()
+            copied = kernel_readwrite(inputfh.fileno(), outfh.fileno(), 0, addenda_size,
+                                      out_offset)
+            outfh.seek(out_offset + copied)
+        if dropcache:
+            drop_page_cache(inputfh.fileno())
+        inputfh.close()
+    outfh.flush()
+    if dropcache: #avoid evicting more useful data from the page cache
+        drop_page_cache(outfh.fileno(), sync=True)
 
 
 def check_args():
@@ -105,11 +190,11 @@ def check_args():
     parse arguments and check for error conditions
     """
     global args, GZTOOL_EXE
-    usagetxt = """{0} -f FLATFILE -i INDEXFILE -e ENTRIESFILE -n NEWINDEXFILE
+    usagetxt = """{0} -f FLATFILE -i INDEXFILE -e ENTRIESFILE [..] -n NEWINDEXFILE [..]
     [-f] : flatfile into which the new entries should be added
     [-i] : index of FLATFILE
-    [-e] : filename containing the new entries to be added
-    [-n] : index of ENTRIESFILE
+    [-e] : filename(s) containing the new entries to be added
+    [-n] : index(es) of ENTRIESFILE(s), in the same order
     see {0} -h for tweaks and optional modes
     \nexamples:
        {0} -f db.dat -i db.pos -e new.dat -n new.pos
@@ -118,6 +203,8 @@ def check_args():
          (will create db.dat.new and db.pos.new)
        {0} -c -o export -f db.dat -i db.pos -e new.dat -n new.pos
          (will create export/db.dat.new and export/db.pos.new)
+       {0} -f db.dat -i db.pos -e new1.dat new2.dat -n new1.pos new2.pos
+         (will update db.dat and db.pos with the entries from both new1 and new2)
     """.format(PROGNAME)
     parser = argparse.ArgumentParser(description='Merge new pre-indexed entries into an existing \
                                      flatfile', usage=usagetxt)
@@ -127,12 +214,12 @@ def check_args():
     parser.add_argument('-i', '--index', dest='index_filename',
                         help="filename of index file with entry identifiers",
                         required=True, type=str)
-    parser.add_argument('-e', '--entries', dest='newentries_filename',
-                        help="filename of new entries to be merged into flatfile",
-                        required=True, type=str)
-    parser.add_argument('-n', '--newindex', dest='newindex_filename',
-                        help="filename of index file with entry identifiers",
+    parser.add_argument('-e', '--entries', dest='newentries_filenames', nargs='+',
+                        help="filename(s) of new entries to be merged into flatfile",
                         required=True, type=str)
+    parser.add_argument('-n', '--newindex', dest='newindex_filenames', nargs='+',
+                        help="filename(s) of index file(s) with entry identifiers, one for \
+                        each of the new entries files", required=True, type=str)
     parser.add_argument('-c', '--create', dest='createmode', action='store_true',
                         help="create new files (.new extension) rather than updating existing \
                         files (the default operation mode)", required=False)
@@ -148,6 +235,13 @@ def check_args():
     parser.add_argument('-g', '--gzip', dest='gzip', action='store_true',
                         help="compress the final flatfile after merge, creating .gzi compressed \
                         index", required=False)
+    parser.add_argument('-j', '--threads', dest='threads',
+                        help="number of threads used for parallel compression with pigz, when \
+                        available (default: all cpus)", required=False, type=int)
+    parser.add_argument('-k', '--keeppagecache', dest='dropcache', action='store_false',
+                        help="keep the merged flatfile in the OS page cache; by default it is \
+                        synced to disk and its pages dropped from the cache after merging",
+                        required=False)
     parser.add_argument('-s', '--small', dest='smallnew', action='store_true',
                         help="use this mode if the new index is small (<30k entries): performance \
                         should be better", required=False)
@@ -164,10 +258,43 @@ def check_args():
             eprint("               it will be uncompressed and then recompressed after merge")
             args.gzip = True
 
+    if len(args.newentries_filenames) != len(args.newindex_filenames):
+        eprint("    => ERROR: the number of new entries files (-e) and of their indexes (-n)")
+        eprint("              should be the same!")
+        sys.exit(22)
+
     args.newentries_compressed = False
-    if args.newentries_filename[-3:] == ".gz":
-        args.newentries_compressed = True
-        eprint("    => NOTICE: -n argument has extension .gz: assuming newentriesfile compressed")
+    for newentries_filename in args.newentries_filenames:
+        if newentries_filename[-3:] == ".gz":
+            args.newentries_compressed = True
+            eprint("    => NOTICE: -e argument '{}' has extension .gz: assuming compressed".format(
+                newentries_filename))
+
+    if args.gzip:
+        #prefer parallel compression with pigz, falling back to single threaded gzip
+        pigz_exe = which("pigz")
+        if pigz_exe is not None:
+            args.compressor_call = [pigz_exe, '-c']
+            if args.threads is not None:
+                args.compressor_call[1:1] = ['-p', str(args.threads)]
+            if args.verbose:
+                eprint(" |-- compressing with pigz using {} threads".format(
+                    args.threads if args.threads is not None else os.cpu_count()))
+        else:
+            gzip_exe = which("gzip")
+            if gzip_exe is None:
+                eprint("    => ERROR: neither pigz nor gzip command found in your path.")
+                sys.exit(2)
+            args.compressor_call = [gzip_exe, '-c']
+            if args.threads is not None:
+                eprint("    => NOTICE: pigz not found in your path: ignoring -j option")
+        if GZTOOL_EXE is None:
+            GZTOOL_EXE = which("gztool")
+            if GZTOOL_EXE is None:
+                eprint("    => ERROR: gztool command not found in your path.")
+                eprint("Creation of the .gzi index for the compressed flatfile depends on it.")
+                eprint("Please install gztool to continue: https://github.com/circulosmeos/gztool")
+                sys.exit(2)
 
     if args.ff_filename.find("://") != -1:
         eprint("    => ERROR: {} cannot operate on remote flatfiles".format(PROGNAME))
@@ -177,8 +304,13 @@ def check_args():
         if args.verbose:
             eprint(" |-- using tweak for smaller new index")
     else:
-        randnum = str(randint(1000, 9999))
-        args.itemp_filename = TEMPDIR + "/tmpMERGE" + randnum
+        #mkstemp creates the files exclusively, hence no collision check needed later
+        args.itemp_filenames = list()
+        for _ in args.newindex_filenames:
+            itemp_fd, itemp_filename = tempfile.mkstemp(prefix="tmpMERGE", dir=TEMPDIR)
+            os.close(itemp_fd)
+            args.itemp_filenames.append(itemp_filename)
+        atexit.register(delete_files, args.itemp_filenames) #cleanup also on errors
 
     if args.outpath is None:
         args.outindex_filename = args.index_filename + ".new"
@@ -224,18 +356,20 @@ def check_files():
     """
     check for ability to open input/output filenames
     """
-    check_iofiles([args.ff_filename, args.newentries_filename, args.index_filename,
-                   args.newindex_filename], [args.outindex_filename])
-
-    if not args.smallnew:
-        check_iofiles(None, [args.itemp_filename])
+    check_iofiles([args.ff_filename, args.index_filename] + args.newentries_filenames +
+                  args.newindex_filenames, [args.outindex_filename])
 
     if args.createmode:
         if args.outpath is None:
             args.outff_filename = args.ff_filename + ".new"
         else:
             args.outff_filename = os.path.join(args.outpath, args.ff_filename + ".new")
-        check_iofiles(None, [args.outff_filename])
+        if args.gzip:
+            check_iofiles(None, [args.outff_filename + ".gz", args.outff_filename + ".gz.gzi"])
+        else:
+            check_iofiles(None, [args.outff_filename])
+    elif args.gzip:
+        check_iofiles(None, [args.ff_filename + ".gz", args.ff_filename + ".gz.gzi"])
 
 
 if __name__ == '__main__':
@@ -246,7 +380,8 @@ if __name__ == '__main__':
     check_files()
 
     #check if old and new indexes are of same type:
-    check_index_compatibility(args.index_filename, args.newindex_filename)
+    for newindex_filename in args.newindex_filenames:
+        check_index_compatibility(args.index_filename, newindex_filename)
 
     #uncompress files if needed
     if args.ff_compressed:
@@ -256,53 +391,77 @@ if __name__ == '__main__':
     if args.newentries_compressed:
         if args.verbose:
             eprint(" |-- uncompressing newentries file.. this may take some time..")
-        args.newentries_filename = uncompress_file(args.newentries_filename)
-
-    #calculate index offset
-    pos_offset = os.path.getsize(args.ff_filename)
+        args.newentries_filenames = [uncompress_file(newentries_filename)
+                                     for newentries_filename in args.newentries_filenames]
+
+    #calculate index offsets: each new entries file will follow the previous ones
+    if args.createmode or args.gzip:
+        ff_fh = None
+        pos_offset = os.path.getsize(args.ff_filename)
+    else: #updatemode: the same handle giving the offset will be used for appending
+        ff_fh = open_for_appending(args.ff_filename)
+        pos_offset = os.fstat(ff_fh.fileno()).st_size
+    pos_offsets = list()
+    for newentries in args.newentries_filenames:
+        pos_offsets.append(pos_offset)
+        pos_offset += os.path.getsize(newentries)
 
     #merge old and new identifiers' indexes
-    if args.smallnew:
-        tempfile = None
+    if args.smallnew: #merge in memory, without temporary files
+        new_identifiers_count = merge_indexes_small(args.index_filename, args.newindex_filenames,
+                                                    pos_offsets, args.outindex_filename)
     else:
-        tempfile = args.itemp_filename
-    new_identifiers_count = merge_indexes(args.index_filename, args.newindex_filename,
-                                          pos_offset, args.index_type,
-                                          args.outindex_filename, tempfile)
+        new_identifiers_count = merge_indexes(args.index_filename, args.newindex_filenames,
+                                              pos_offsets, args.index_type,
+                                              args.outindex_filename, args.itemp_filenames)
 
     #create new flatfile or update original flatfile
     if args.createmode:
         if args.verbose:
             eprint(" |-- new indexfile created: '{}'".format(args.outindex_filename))
-        concatenate_into(args.ff_filename, args.newentries_filename, args.outff_filename)
-        if args.gzip: #compress flatfile
+        if args.gzip: #concatenate and compress flatfile in a single pass
             if args.verbose:
                 eprint(" |-- compressing new flatfile.. this may take some time..")
-            args.outff_filename = compress_file(args.outff_filename, create_gzindex=True)
+            args.outff_filename = compress_file([args.ff_filename] + args.newentries_filenames,
+                                                args.outff_filename, create_gzindex=True)
             if args.verbose:
                 eprint(" |-- new compressed flatfile created: '{}'".format(args.outff_filename))
         else:
+            concatenate_into(args.ff_filename, args.newentries_filenames, args.outff_filename,
+                             args.dropcache)
             if args.verbose:
                 eprint(" |-- new flatfile created: '{}'".format(args.outff_filename))
     else: #updatemode
-        os.replace(args.outindex_filename, args.index_filename)
-        if args.verbose:
-            eprint(" '-- original indexfile updated: '{}'".format(args.index_filename))
-        append_to_buffered(args.ff_filename, args.newentries_filename)
-        if args.gzip: #compress flatfile
+        if args.gzip: #append and compress flatfile in a single pass
             if args.verbose:
                 eprint(" |-- compressing updated flatfile.. this may take some time..")
-            args.ff_filename = compress_file(args.ff_filename, create_gzindex=True)
+            uncompressed_filename = args.ff_filename
+            #index is replaced only once compression succeeded, not to point past the flatfile
+            try:
+                args.ff_filename = compress_file([args.ff_filename] + args.newentries_filenames,
+                                                 args.ff_filename, create_gzindex=True)
+            except SystemExit:
+                delete_files([args.outindex_filename]) #original index left untouched
+                raise
+            os.replace(args.outindex_filename, args.index_filename)
+            if args.verbose:
+                eprint(" '-- original indexfile updated: '{}'".format(args.index_filename))
+            delete_files([uncompressed_filename]) #replaced by compressed one, as gzip does
             if args.verbose:
                 eprint(" |-- original flatfile updated and compressed: '{}'".format(
                     args.ff_filename))
         else:
+            os.replace(args.outindex_filename, args.index_filename)
+            if args.verbose:
+                eprint(" '-- original indexfile updated: '{}'".format(args.index_filename))
+            append_to_buffered(ff_fh, args.newentries_filenames, args.dropcache)
+            ff_fh.close()
             if args.verbose:
                 eprint(" |-- original flatfile updated: '{}'".format(args.ff_filename))
 
     #final cleanup, if desired
     if args.deleteafter:
-        delete_files([args.newentries_filename, args.newindex_filename])
+        delete_files(args.newentries_filenames + args.newindex_filenames)
 
     #final printout
     eprint(" '-- merged {} new entries".format(new_identifiers_count))
@@ -9,24 +9,34 @@ by Giuseppe Insana, 2020
 # pylint: disable=C0103,R0912,R0915,W0603
 
 #IMPORTS:
+import io
 import os
+import mmap
 import sys
 import time
 import argparse
+from math import ceil
+from bisect import bisect_right
 from random import randint
-from multiprocessing import Pool, Array, set_start_method
-from sortedcontainers import SortedList
+from multiprocessing import Pool, set_start_method
+from sortedcontainers import SortedDict
 from tqdm import tqdm #progress bar
 from ffdb import eprint, check_iofiles, b64_to_int, int_to_b64, \
     print_subfiles, elapsed_time, TEMPDIR, siprefix2num, calculate_chunknum, \
-    calculate_blocksize, check_index, FIELDSEPARATOR, REESIVN, REES, BUFFERSIZE, \
+    calculate_blocksize, batch, check_index, FIELDSEPARATOR, REESIV, REES, BUFFERSIZE, \
     get_position_first, get_position_last, get_positions, delete_files, split_file, \
-    PROGRESSBARCHARS
+    kernel_readwrite, drop_page_cache, advise_sequential, B64_SORTABLE, PROGRESSBARCHARS
 
 #CUSTOMIZATIONS:
 #you can modify the minimum default size of block (chunk) of index identifiers
 #to work on for parallel execution
 MINBLOCKSIZE = "40k" #40 kb of index identifiers per chunk
+#minimum number of identifiers to delete for which the bulk mode (-s) reads the whole index,
+#rather than searching it for each identifier
+MINBULKIDENTIFIERS = 1000
+#maximum size of index kept in memory in bulk mode, to update it without reading it again;
+#it is kept as raw blocks, hence costing about its own size in memory
+MAXBULKINDEXSIZE = 1 << 29 #512 mb
 
 #CONSTANTS
 PROGNAME = "remover.py"
@@ -76,8 +86,19 @@ def check_args():
                         help="specify INDEX_FILE contains duplicate identifiers and request \
                         deletion of last entry appearing in the flatfile (default is the first)",
                         required=False)
+    parser.add_argument('-s', '--bulk', dest='bulk', action='store_true',
+                        help="bulk mode: find the entries to delete walking once through the \
+                        whole index, faster when deleting many entries; applied only when \
+                        deleting at least {} of them".format(MINBULKIDENTIFIERS),
+                        required=False)
+    parser.add_argument('-k', '--keeppagecache', dest='dropcache', action='store_false',
+                        help="keep flatfiles and indexes in the OS page cache; by default the \
+                        new ones are synced to disk and their pages, as well as those of the \
+                        original ones, dropped from the cache after use",
+                        required=False)
     parser.add_argument('-t', '--threads', dest='threads',
-                        help="use specified number of multiple threads for parallel reindexing",
+                        help="use specified number of multiple threads for parallel deletion \
+                        and reindexing",
                         required=False, type=int)
     parser.add_argument('-b', '--blocksize', dest='index_blocksize',
                         help="redefine blocksize used for parallel execution. By default \
@@ -227,16 +248,22 @@ def collect_entry(indexfh, identifier):
             eprint("    => WARNING: '{}' not found in index; skipping".format(identifier))
         return [], []
 
+    return decode_positions(positions)
+
+
+def decode_positions(positions):
+    """
+    decode position and size of entries from the position column of their indexes
+    """
     entry_positions = list()
     entry_lengths = list()
 
     for position in positions:
         #1) extract position and entry size
         if args.encrypted: #with iv
-            posmatch = REESIVN.match(position)
+            entry_position, entry_length, _ = REESIV.match(position).groups()
         else: #no iv
-            posmatch = REES.match(position)
-        entry_position, entry_length = posmatch.groups()
+            entry_position, entry_length = REES.match(position).groups()
 
         #2) decode and append to lists
         entry_positions.append(b64_to_int(entry_position))
@@ -245,159 +272,293 @@ def collect_entry(indexfh, identifier):
     return entry_positions, entry_lengths
 
 
-def collect_entries_to_delete(list_filename, index_filename):
+def sweep_entries_to_delete(identifiers, index_filename, keep_blocks=False):
     """
-    collect information about entries to delete, consulting the index,
-    return a sorted list and a dict
+    find position and size of entries corresponding to the specified identifiers
+    walking once through the whole index, rather than searching it for each of them
+    optionally keep the index read, as raw blocks of whole lines, to reindex without
+    reading it again
+    returns lists of positions and sizes, and the blocks (or None)
     """
-    indexfh = open(index_filename, 'r', 1)
+    fieldseparator = FIELDSEPARATOR.encode()
+    identifier2positions = dict()
+    wanted = set(identifier.encode() for identifier in identifiers)
+    index_blocks = list() if keep_blocks else None
+    with open(index_filename, 'rb') as indexfh:
+        advise_sequential(indexfh.fileno())
+        while True:
+            block = indexfh.read(BUFFERSIZE) #process a block of lines at a time
+            if not block:
+                break
+            if block[-1:] != b"\n": #complete the last line
+                block += indexfh.readline()
+            if keep_blocks: #one bytes object per block, rather than one per line
+                index_blocks.append(block)
+            for line in block.split(b"\n"):
+                identifier, _, rest = line.partition(fieldseparator)
+                if identifier not in wanted:
+                    continue
+                position = rest.rstrip().split(fieldseparator)[0].decode()
+                identifier = identifier.decode()
+                if args.duplicates:
+                    identifier2positions.setdefault(identifier, list()).append(position)
+                elif args.zfound or identifier not in identifier2positions: #last or first
+                    identifier2positions[identifier] = [position]
+
+    positions = list()
+    for identifier in identifiers:
+        if identifier in identifier2positions:
+            positions.extend(identifier2positions[identifier])
+        elif args.verbose:
+            eprint("    => WARNING: '{}' not found in index; skipping".format(identifier))
+    entry_positions, entry_sizes = decode_positions(positions)
+    return entry_positions, entry_sizes, index_blocks
 
-    all_entries_positions = SortedList()
-    all_entries_position2size = dict()
 
-    identifiers_count = 0
+def collect_entries_batch(job):
+    """
+    find positions and sizes of the entries for a batch of identifiers
+    to be run also by multithreaded workers, each with its own index filehandle
+    """
+    index_filename, identifiers = job
+    batch_positions = list()
+    batch_sizes = list()
     with open(index_filename) as indexfh:
-        with open(list_filename) as listfh:
-            for line in listfh:
-                identifier = line.rstrip()
-                identifiers_count += 1
-                entry_positions, entry_sizes = collect_entry(indexfh, identifier)
-                if entry_positions:
-                    #eprint("got positions {} and sizes {} for identifier {}".format(
-                    #   entry_positions, entry_sizes, identifier)) #debug
-                    all_entries_positions.update(entry_positions) #add to sorted list
-                    for entry_position, entry_size in zip(entry_positions, entry_sizes):
-                        all_entries_position2size[entry_position] = entry_size #update dict
-
-    return all_entries_positions, all_entries_position2size, identifiers_count
-
-
-def delete_entries(inputfile, outputfile, sorted_positions, position2size):
+        for identifier in identifiers:
+            entry_positions, entry_sizes = collect_entry(indexfh, identifier)
+            #eprint("got positions {} and sizes {} for identifier {}".format(
+            #   entry_positions, entry_sizes, identifier)) #debug
+            batch_positions.extend(entry_positions)
+            batch_sizes.extend(entry_sizes)
+    return batch_positions, batch_sizes
+
+
+def collect_entries_to_delete(list_filename, index_filename, threads=1):
     """
-    delete the entries from input_filename writing into output_filename
-    according to given positions and sizes
+    collect information about entries to delete, consulting the index,
+    optionally with multithread
+    return a dict of sizes sorted by position, the number of identifiers and,
+    when in bulk mode with a single thread, the blocks of lines of a small enough index
+    """
+    with open(list_filename) as listfh:
+        identifiers = [line.rstrip() for line in listfh]
+
+    all_entries = SortedDict() #position -> size, sorted by position
+    index_blocks = None
+
+    if args.bulk and len(identifiers) >= MINBULKIDENTIFIERS: #single sequential pass on index
+        if args.verbose:
+            eprint(" |-- [-s] option selected: index will be read through in a single pass")
+        #if reindexing will be done in this same process, keep the index read to reuse it
+        keep_blocks = threads == 1 and os.path.getsize(index_filename) <= MAXBULKINDEXSIZE
+        batch_positions, batch_sizes, index_blocks = sweep_entries_to_delete(
+            identifiers, index_filename, keep_blocks)
+        all_entries.update(zip(batch_positions, batch_sizes))
+    elif threads > 1 and len(identifiers) > 1: #multithread: submit identifiers in batches
+        batchsize = ceil(len(identifiers) / threads)
+        jobs = [(index_filename, identifiers_batch)
+                for identifiers_batch in batch(identifiers, batchsize)]
+        with Pool(threads) as pool:
+            for batch_positions, batch_sizes in pool.imap_unordered(collect_entries_batch, jobs):
+                all_entries.update(zip(batch_positions, batch_sizes))
+    else:
+        batch_positions, batch_sizes = collect_entries_batch((index_filename, identifiers))
+        all_entries.update(zip(batch_positions, batch_sizes))
+
+    return all_entries, len(identifiers), index_blocks
+
+
+def compute_kept_segments(sorted_entries, input_size):
+    """
+    compute the pieces of inputfile to keep, given the positions and sizes
+    of the entries to delete
+    returns a list of (input position, output position, size) segments
     """
+    segments = list()
     current_position = 0 #start from beginning
+    output_position = 0
+    #the end of inputfile acts as a final deletion of size 0, to keep the last piece
+    deletions = list(sorted_entries.items())
+    deletions.append((input_size, 0))
+    for entry_position, entry_size in deletions:
+        write_size = entry_position - current_position
+        if write_size > 0: #no sense writing nothing
+            segments.append((current_position, output_position, write_size))
+            output_position += write_size
+        current_position += write_size + entry_size #skip to after the entry being deleted
+    return segments
+
+
+def copy_segments(job):
+    """
+    copy the given segments of inputfile into outputfile, at their output positions
+    to be run by multithreaded workers, each with its own file descriptors
+    """
+    inputfile, outputfile, segments = job
+    input_fd = os.open(inputfile, os.O_RDONLY)
+    output_fd = os.open(outputfile, os.O_WRONLY)
+    advise_sequential(input_fd)
+    try:
+        for input_position, output_position, write_size in segments:
+            kernel_readwrite(input_fd, output_fd, input_position, write_size, output_position)
+    finally:
+        os.close(input_fd)
+        os.close(output_fd)
+
+
+def delete_entries(inputfile, outputfile, sorted_entries, threads=1, dropcache=False):
+    """
+    delete the entries from input_filename writing into output_filename
+    according to given positions and sizes, optionally with multithread
+    optionally drop both files from the page cache at the end
+    returns the size of input_filename
+    """
     with open(inputfile, 'rb') as inputfh:
-        with open(outputfile, 'wb') as outfh:
-            for entry_position in sorted_positions:
-                entry_size = position2size[entry_position]
-                write_size = entry_position - current_position
-                if write_size > 0: #no sense writing nothing
-                    inputfh.seek(current_position)
+        advise_sequential(inputfh.fileno())
+        input_size = os.fstat(inputfh.fileno()).st_size
+        #all the copies to perform are computed first, then issued in a batch
+        segments = compute_kept_segments(sorted_entries, input_size)
+        if threads > 1 and len(segments) > 1: #multithread
+            output_size = segments[-1][1] + segments[-1][2]
+            with open(outputfile, 'wb') as outfh:
+                os.ftruncate(outfh.fileno(), output_size) #so that workers can write anywhere
+            #split segments into contiguous groups of similar total size
+            #output positions are the running sum of the sizes to write
+            segments_groups = [list() for _ in range(threads)]
+            for segment in segments:
+                segments_groups[segment[1] * threads // output_size].append(segment)
+            jobs = [(inputfile, outputfile, segments_group)
+                    for segments_group in segments_groups if segments_group]
+            with Pool(threads) as pool: #output ranges are disjoint, no locking needed
+                pool.map(copy_segments, jobs)
+        else:
+            with open(outputfile, 'wb') as outfh:
+                for input_position, output_position, write_size in segments:
                     #eprint("  .. writing {} bytes from {}".format( #debug
-                    #   write_size, current_position)) #debug
-                    #buffered write:
-                    blockcount, remainder = divmod(write_size, BUFFERSIZE)
-                    for _ in range(blockcount):
-                        buffered = inputfh.read(BUFFERSIZE)
-                        outfh.write(buffered)
-                    outfh.write(inputfh.read(remainder))
-                current_position += write_size + entry_size #skip to after the entry being deleted
-
-            #write the last piece of inputfile after last entry
-            write_size = os.path.getsize(inputfile) - current_position
-            if write_size > 0: #no sense writing nothing
-                inputfh.seek(current_position)
-                #eprint("  .. writing {} bytes from {}".format( #debug
-                #   write_size, current_position)) #debug
-                #buffered write:
-                blockcount, remainder = divmod(write_size, BUFFERSIZE)
-                for _ in range(blockcount):
-                    buffered = inputfh.read(BUFFERSIZE)
-                    outfh.write(buffered)
-                outfh.write(inputfh.read(remainder))
-            current_position += entry_size #skip to after the entry being deleted
-
-            outfh.flush()
-
-
-def find_shift_offset(position, sorted_positions, position2offset):
+                    #   write_size, input_position)) #debug
+                    #in-kernel copy, where available:
+                    kernel_readwrite(inputfh.fileno(), outfh.fileno(),
+                                     input_position, write_size, output_position)
+        if dropcache: #avoid evicting more useful data from the page cache
+            drop_page_cache(inputfh.fileno())
+            with open(outputfile, 'rb') as outfh:
+                drop_page_cache(outfh.fileno(), sync=True)
+    return input_size
+
+
+def shift_index_block(lines, sorted_positions, offsets, fieldseparator, index_type_sep,
+                      buffered):
     """
-    Find the offset to apply to a position,
-    depending on cumulative sizes of entries deleted before it
+    kernel of index update: shift positions in a block of index lines (bytes)
+    depending on cumulative sizes of entries deleted before each of them
+    offsets[i] holds the cumulative size of the first i deleted entries
+    lines of entries which were themselves deleted are dropped
+    the updated lines are appended to the given (reusable) bytearray buffer
+    returns the count of dropped and the count of unshifted lines
     """
-    first_deleted_position = sorted_positions[0]
-    offset = 0
-    if position < first_deleted_position:
-        #quick heuristic: no need to check if position lower than first deleted
-        #eprint("{}: before any deletions, no change".format(position)) #DEBUG
-        return offset
-    for deleted_position in reversed(sorted_positions):
-        if position >= deleted_position:
-            offset = position2offset[deleted_position]
-            #eprint("{} >= {} so should decrement by {}".format( #debug
-            #   position, deleted_position, offset)) #debug
-            break
-    #if offset == 0: #debug
-    #   eprint("{}: no change".format(position)) #debug
-    return offset
+    skipped_count = 0
+    unshifted_count = 0
+    #encoded positions before the first deleted one are recognised without decoding them:
+    #shorter ones are smaller, those of the same length compare as their sortable translation
+    if sorted_positions:
+        first_deleted = int_to_b64(sorted_positions[0]).encode().translate(B64_SORTABLE)
+        first_deleted_length = len(first_deleted)
+        #positions after the last deleted one are all shifted by the total size deleted
+        last_deleted_position = sorted_positions[-1]
+        total_offset = offsets[-1]
+    else: #nothing deleted, nothing to shift
+        first_deleted = b""
+        first_deleted_length = sys.maxsize
+        last_deleted_position = -1
+        total_offset = 0
+    for line in lines:
+        #the index type character separates position from the rest (size, iv, checksum)
+        identifier, _, posfield = line.partition(fieldseparator)
+        position, _, remaining = posfield.partition(index_type_sep)
+        position_length = len(position)
+        if position_length < first_deleted_length or (
+                position_length == first_deleted_length and
+                position.translate(B64_SORTABLE) < first_deleted): #before first deletion
+            unshifted_count += 1
+            buffered += line
+            continue
+        position = b64_to_int(position)
+        if position > last_deleted_position: #constant shift, no need to search
+            offset = total_offset
+        else:
+            #binary search for how many deleted positions are not greater than position
+            deleted_count = bisect_right(sorted_positions, position)
+            if deleted_count and sorted_positions[deleted_count - 1] == position: #deleted entry
+                skipped_count += 1
+                continue
+            offset = offsets[deleted_count]
+        if offset:
+            buffered += identifier + fieldseparator + int_to_b64(position - offset).encode() + \
+                index_type_sep + remaining
+        else: #no need to rebuild the line
+            unshifted_count += 1
+            buffered += line
+    return skipped_count, unshifted_count
 
 
 def update_index_after_deletions(index_filename, outfile,
-                                 sorted_positions, position2offset,
-                                 index_type):
+                                 sorted_positions, offsets,
+                                 index_type, index_blocks=None, dropcache=False):
     """
     update index file, creating outindex with entry positions shifted according to
     information given
+    if given the raw blocks of the index already read, these are used
+    optionally drop both indexes from the page cache at the end
     """
-    #go through index and shift positions according to dict with offsets
-    #for how much to shift entries found after a specified position
-    buffered = ""
+    #go through index and shift positions according to list with offsets
+    #for how much to shift entries found after each deleted position
+    #index is processed in binary mode, hence bytes versions of separators
+    fieldseparator = FIELDSEPARATOR.encode()
+    index_type_sep = index_type.encode()
+    buffered = bytearray() #output buffer, reused for all blocks
     all_indexes_count = 0
     skipped_count = 0
-    shifted_count = 0
     unshifted_count = 0
-    buflines = 100 #write every 100 lines
-    bufcounter = 0
-    with open(index_filename, 'r', 1) as indexfh: #using line buffering
-        with open(outfile, 'w') as outfh:
-            for line in indexfh:
-                columns = line.rstrip().split(FIELDSEPARATOR)
-                position = columns[1] #2nd column of index file is position
-                if index_type in ("+", "."): #entry sizes and iv stored
-                    posmatch = REESIVN.match(position)
-                elif index_type in (":", "-"): #entry sizes stored, no iv
-                    posmatch = REES.match(position)
-                position, remaining = posmatch.groups()
-                position = b64_to_int(position)
-                if position in position2offset:
-                    skipped_count += 1
-                    continue
-                if bufcounter > buflines: #write to outfile and reset buffer
-                    outfh.write(buffered)
-                    all_indexes_count += bufcounter
-                    bufcounter = 0
-                    buffered = ""
-
-                offset = find_shift_offset(position, sorted_positions, position2offset)
-                if offset > 0:
-                    columns[1] = "{}{}{}".format(int_to_b64(position - offset),
-                                                 index_type,
-                                                 remaining)
-                else:
-                    unshifted_count += 1
-                bufcounter += 1
-                buffered += FIELDSEPARATOR.join(columns) + "\n"
-            all_indexes_count += bufcounter
-            outfh.write(buffered) #last block
-            shifted_count = all_indexes_count - unshifted_count
-            all_indexes_count += skipped_count
+    cursor = 0 #write position in output
+    with open(index_filename, 'rb') as indexfh:
+        with open(outfile, 'w+b') as outfh:
+            #positions are only shifted down, so output cannot be larger than input
+            #(plus a final newline, if missing): map output at that size and write
+            #into it, truncating at the end
+            input_size = os.fstat(indexfh.fileno()).st_size
+            if input_size == 0: #nothing to map
+                return 0, 0, 0
+            outfh.truncate(input_size + 1)
+            outmm = mmap.mmap(outfh.fileno(), input_size + 1)
+            if index_blocks is None: #process a block of lines at a time
+                advise_sequential(indexfh.fileno())
+                blocks_lines = iter(lambda: indexfh.readlines(BUFFERSIZE), [])
+            else: #split in lines one block at a time, only now
+                blocks_lines = (io.BytesIO(block).readlines() for block in index_blocks)
+            for lines in blocks_lines:
+                if lines[-1][-1:] != b"\n": #last line of index without newline
+                    lines[-1] += b"\n"
+                block_skipped_count, block_unshifted_count = shift_index_block(
+                    lines, sorted_positions, offsets, fieldseparator, index_type_sep, buffered)
+                outmm[cursor:cursor + len(buffered)] = buffered
+                cursor += len(buffered)
+                buffered.clear()
+                all_indexes_count += len(lines)
+                skipped_count += block_skipped_count
+                unshifted_count += block_unshifted_count
+            outmm.close()
+            outfh.truncate(cursor)
+            if dropcache: #avoid evicting more useful data from the page cache
+                drop_page_cache(indexfh.fileno())
+                drop_page_cache(outfh.fileno(), sync=True)
+    shifted_count = all_indexes_count - skipped_count - unshifted_count
     return all_indexes_count, shifted_count, skipped_count
 
 
-def print_stats(start_time):
+def print_stats(start_time, indexes_sum, reindexed_sum, deleted_sum):
     """
     print some final statistics on entries deleted
     """
-    indexes_sum = 0
-    deleted_sum = 0
-    reindexed_sum = 0
-    for chunknum in range(args.chunks_count):
-        indexes_sum += indexes_count[chunknum]
-        reindexed_sum += reindexed_count[chunknum]
-        deleted_sum += deleted_count[chunknum]
-
     if found_count == 1:
         eprint(" |-- Found and removed 1 entry.")
     elif found_count > 0:
@@ -420,8 +581,8 @@ def print_stats(start_time):
 def update_index_wrapper(chunknum):
     """
     wrapper to shift index for multithread use
+    returns counts of indexes, of reindexed and of deleted ones
     """
-    #global reindexed_count, deleted_count
     if args.threads > 1:
         index_filename = args.chunk_itempfiles[chunknum]
         outindex_filename = args.chunk_otempfiles[chunknum]
@@ -429,20 +590,9 @@ def update_index_wrapper(chunknum):
         index_filename = args.index_filename
         outindex_filename = args.outindex_filename
 
-    indexes_count[chunknum], reindexed_count[chunknum], \
-        deleted_count[chunknum] = update_index_after_deletions(
-            index_filename, outindex_filename, mysorted_positions,
-            myposition2offset, args.index_type)
-
-
-def init_thread(i, r, d):
-    """
-    to initialise multithreaded worker
-    """
-    global indexes_count, reindexed_count, deleted_count
-    indexes_count = i
-    reindexed_count = r
-    deleted_count = d
+    return update_index_after_deletions(index_filename, outindex_filename, mysorted_positions,
+                                        myoffsets, args.index_type, myindex_blocks,
+                                        args.dropcache and args.threads == 1)
 
 
 if __name__ == '__main__':
@@ -456,29 +606,34 @@ if __name__ == '__main__':
 
     start_secs = time.time()
 
+    if args.threads > 1: #multithread
+        if sys.version_info[1] > 7: #from py3.8
+            set_start_method('fork') #spawn not implemented
+
     #1) collect information from index on entries to delete
-    mysorted_positions, myposition2size, \
-        requested_count = collect_entries_to_delete(args.list_filename, args.index_filename)
-    found_count = len(mysorted_positions)
+    mysorted_entries, requested_count, myindex_blocks = collect_entries_to_delete(
+        args.list_filename, args.index_filename, args.threads)
+    found_count = len(mysorted_entries)
 
-    #2) delete entries from flatfile
-    delete_entries(args.flatfile, args.output_filename, mysorted_positions, myposition2size)
+    #2) delete entries from flatfile, optionally with multithread
+    flatfile_size = delete_entries(args.flatfile, args.output_filename, mysorted_entries,
+                                   args.threads, args.dropcache)
 
-    #3) fill dict with cumulative offsets, used to update index
-    myposition2offset = dict()
+    #3) fill list with cumulative offsets (myoffsets[i] for the first i deletions),
+    #   used to update index; a plain list of positions allows C-level binary search
+    myoffsets = [0]
     size_offset = 0
-    for myentry_position in mysorted_positions:
-        size_offset += myposition2size[myentry_position]
-        myposition2offset[myentry_position] = size_offset
+    for myentry_size in mysorted_entries.values():
+        size_offset += myentry_size
+        myoffsets.append(size_offset)
+    mysorted_positions = list(mysorted_entries.keys())
     #eprint("removed a total of {} bytes".format(size_offset)) #debug
-    if os.path.getsize(args.flatfile) - size_offset != os.path.getsize(args.output_filename):
+    if flatfile_size - size_offset != os.path.getsize(args.output_filename):
         eprint("    => ERROR: problems with deletion, file size of resulting file is wrong")
         sys.exit(1)
 
     #4) update the index shifting positions, optionally with multithread
     if args.threads > 1: #multithread
-        if sys.version_info[1] > 7: #from py3.8
-            set_start_method('fork') #spawn not implemented
         args.chunk_itempfiles, _ = split_file(args.index_filename,
                                               args.index_blocksize,
                                               args.mt_subfiles_iprefix)
@@ -489,35 +644,26 @@ if __name__ == '__main__':
                 args.index_blocksize))
             eprint(" |-- index will be split into {} chunks".format(args.chunks_count))
 
-        indexes_count = Array('i', [0] * args.chunks_count)
-        reindexed_count = Array('i', [0] * args.chunks_count)
-        deleted_count = Array('i', [0] * args.chunks_count)
-
         args.chunk_otempfiles = args.chunk_otempfiles[0:args.chunks_count]
 
         #init threads
-        pool = Pool(args.threads, initializer=init_thread,
-                    initargs=(indexes_count, reindexed_count, deleted_count))
-        #submit chunks to threads
+        pool = Pool(args.threads)
+        #submit chunks to threads, summing up the counts they return
+        chunks_counts = pool.imap_unordered(update_index_wrapper, range(args.chunks_count))
         if args.progressbar:
-            _ = list(tqdm(pool.imap(update_index_wrapper, range(args.chunks_count)),
-                          total=args.chunks_count, ascii=PROGRESSBARCHARS))
-        else:
-            pool.imap(update_index_wrapper, range(args.chunks_count))
+            chunks_counts = tqdm(chunks_counts, total=args.chunks_count, ascii=PROGRESSBARCHARS)
+        indexes_count, reindexed_count, deleted_count = map(sum, zip(*chunks_counts))
         pool.close() #no more work to submit
         pool.join() #wait workers to finish
 
         delete_files(args.chunk_itempfiles) #cleanup
 
-        #final union of results: combine shifted index chunks
+        #final union of results: combine shifted index chunks, deleting them as they go
         with open(args.outindex_filename, 'wb') as outputfh:
-            print_subfiles(args.chunk_otempfiles, outputfh)
-
-        delete_files(args.chunk_otempfiles) #cleanup
+            print_subfiles(args.chunk_otempfiles, outputfh, delete=True)
+            if args.dropcache: #avoid evicting more useful data from the page cache
+                drop_page_cache(outputfh.fileno(), sync=True)
     else:
-        indexes_count = [0]
-        deleted_count = [0]
-        reindexed_count = [0]
-        update_index_wrapper(0)
+        indexes_count, reindexed_count, deleted_count = update_index_wrapper(0)
 
-    print_stats(start_secs)
+    print_stats(start_secs, indexes_count, reindexed_count, deleted_count)
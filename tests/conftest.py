@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+fixtures shared by the ffdb tests
+"""
+import ffdb
+import pytest
+
+PASSPHRASE = "The quick brown fox jumps over the lazy dog"
+
+
+@pytest.fixture(scope="session")
+def tmp_test_dir(tmpdir_factory):
+    temporary_test_dir = tmpdir_factory.mktemp("ffdb")
+    return temporary_test_dir
+
+
+@pytest.fixture(scope="session")
+def derived_keys():
+    """
+    cipher names and keys derived from the test passphrase, by keysize
+    """
+    return {keysize: ffdb.derive_key(PASSPHRASE, keysize) for keysize in (16, 24, 32)}
+
+
+@pytest.fixture(scope="session")
+def iv():
+    return ffdb.generate_iv()
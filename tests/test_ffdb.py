@@ -4,9 +4,15 @@ tests for ffdb
 simply run 'pytest' to run all tests
 """
 import os
+import mmap
+import sys
+import runpy
+import multiprocessing
+import hashlib
+import time
 import ffdb
 import pytest
-from subprocess import Popen, PIPE, DEVNULL
+from functools import partial
 
 data = """
 Sed ut perspiciatis unde omnis iste natus error sit voluptatem accusantium
@@ -22,10 +28,11 @@ ex ea commodi consequatur? Quis autem vel eum iure reprehenderit qui in ea
 voluptate velit esse quam nihil molestiae consequatur, vel illum qui dolorem
 eum fugiat quo voluptas nulla pariatur?
 """
+DATA_BYTES = data.encode('UTF-8')
 
 entry = dict()
 entry['full'] = data
-entry['length_b64'] = ffdb.int_to_b64(len(data))
+entry['length_b64'] = 'dz' #len(data) == 867, checked in test_b64_conversion
 entry['position'] = 0
 entry['ids'] = ['lorem', 'ipsum', 'lorem ipsum']
 entry['iv'] = b'N\x8e\xd8\xae\x08\x0c\x18\xab\xf4_\x93\x87\x95\x01\x01X'
@@ -33,33 +40,103 @@ entry['iv'] = b'N\x8e\xd8\xae\x08\x0c\x18\xab\xf4_\x93\x87\x95\x01\x01X'
 testfile = 'tests/dogtest.dat' #8 UniProt entries of Canis lupus familiaris
 testindex_ac = 'tests/dogtest.ac.idx'
 testlist_ac = 'tests/dogtest.ac'
+scriptsdir = 'scripts'
 
+STDOUT_BUFFERSIZE = 1048576
+THROUGHPUT_PAYLOADSIZE = 1048576
+DEFLATE_MINTHROUGHPUT = 2e6 #bytes/sec
+CIPHER_MINTHROUGHPUT = 2e6 #bytes/sec, AES-CFB8 with a native backend reaches 40MB/s and more
 
-@pytest.fixture(scope="session")
-def tmp_test_dir(tmpdir_factory):
-    temporary_test_dir = tmpdir_factory.mktemp("ffdb")
-    return temporary_test_dir
+
+def run_script(script, arguments, monkeypatch):
+    """
+    run one of the scripts in-process, as if called from the command line
+    """
+    script_path = os.path.join(scriptsdir, script)
+    if not os.path.isfile(script_path):
+        pytest.skip("script '{}' not found".format(script_path))
+    monkeypatch.setattr(sys, 'argv', [script] + arguments)
+    #scripts set the multiprocessing start method, which is allowed once per process
+    monkeypatch.setattr(multiprocessing, 'set_start_method',
+                        partial(multiprocessing.set_start_method, force=True))
+    #plain text stdout, as scripts expect, flushed to the capture file in large blocks
+    with open(1, 'w', buffering=STDOUT_BUFFERSIZE, closefd=False) as stdout:
+        monkeypatch.setattr(sys, 'stdout', stdout)
+        runpy.run_path(script_path, run_name='__main__')
+
+
+def write_flatfile(filename, identifiers):
+    """
+    write a flatfile with an entry, of varying length, for each of given identifiers
+    """
+    with open(filename, 'w') as fh:
+        for number, identifier in enumerate(identifiers):
+            fh.write("AC   {};\n".format(identifier))
+            fh.writelines("SQ   {}\n".format(data[:number % 97]) for _ in range(number % 13))
+            fh.write("//\n")
+
+
+def file_digest(filename):
+    """
+    compute the sha256 digest of a file, hashing it in one go from a memory map
+    """
+    with open(filename, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).digest()
+
+
+def best_throughput(function, payload, rounds=3):
+    """
+    best throughput, in bytes per second, of a function processing a payload
+    """
+    best_time = None
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        function(payload)
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return len(payload) / best_time
 
 
 class TestIndexFormats:
-    def test_format_indexes(self):
+    @pytest.mark.parametrize("try_index_type", ["-", ".", ":", "+"])
+    def test_format_indexes(self, try_index_type):
         """
         Check for correct parsing of indexes
         """
         cipher_type = "A"
-        for try_index_type in ("-", ".", ":", "+"):
-            new_indexes = ffdb.format_indexes(entry, try_index_type,
-                                              cipher_type, checksums=False)
-            assert len(new_indexes) == len(entry['ids'])
+        new_indexes = ffdb.format_indexes(entry, try_index_type,
+                                          cipher_type, checksums=False)
+        assert len(new_indexes) == len(entry['ids'])
 
-            firstline = new_indexes[0].rstrip()
-            ffdb.eprint("index_type: '{}', index_line: '{}'".format(try_index_type, firstline))
+        firstline = new_indexes[0].rstrip()
+        ffdb.eprint("index_type: '{}', index_line: '{}'".format(try_index_type, firstline))
 
-            index_type, cipher_name, keysize, _ = ffdb.check_index(firstline)
+        index_type, cipher_name, keysize, _ = ffdb.check_index(firstline)
 
-            assert try_index_type == index_type
-            if cipher_name is not None:
-                assert cipher_type == ffdb.get_cipher_type(cipher_name)
+        assert try_index_type == index_type
+        if cipher_name is not None:
+            assert cipher_type == ffdb.get_cipher_type(cipher_name)
+
+    def test_b64_conversion(self):
+        """
+        Check for correct conversion of numbers to and from base64
+        """
+        assert ffdb.int_to_b64(0) == '0'
+        assert ffdb.int_to_b64(63) == '}'
+        assert ffdb.int_to_b64(64) == '10'
+        assert ffdb.int_to_b64(4096) == '100'
+        assert ffdb.int_to_b64(len(data)) == entry['length_b64']
+        for number in (0, 1, 63, 64, 4095, 4096, 262143, 262144, len(data), 2 ** 40 + 17):
+            string = ffdb.int_to_b64(number)
+            assert ffdb.b64_to_int(string) == number
+            assert ffdb.b64_to_int(string.encode()) == number
+        #same length encoded numbers sort as their values once translated
+        numbers = list(range(4096, 262144, 997))
+        translated = [ffdb.int_to_b64(number).encode().translate(ffdb.B64_SORTABLE)
+                      for number in numbers]
+        assert translated == sorted(translated)
 
 
 class TestEntryProcessing:
@@ -68,57 +145,81 @@ class TestEntryProcessing:
         compression/decompression
         encryption/decryption
     """
-    def test_deflate(self):
-        bytestring = data.encode('UTF-8')
-        deflated = ffdb.deflate(bytestring, 9)
+    @pytest.mark.parametrize("inflate_backend", ["zlib", "zlib_ng"])
+    def test_deflate(self, inflate_backend, monkeypatch):
+        if inflate_backend == "zlib_ng":
+            monkeypatch.setattr(ffdb, 'inflate_zlib',
+                                pytest.importorskip("zlib_ng.zlib_ng"))
+        else:
+            monkeypatch.setattr(ffdb, 'inflate_zlib', ffdb.zlib)
+        deflated = ffdb.deflate(DATA_BYTES, 9)
         inflated = ffdb.inflate(deflated).decode('UTF-8')
         ffdb.eprint("testing inflate/deflate of data")
         assert inflated == data, "problems with compression or uncompression"
 
-    def test_ciphers(self):
-        global SALT
-        SALT = b'5ed3a4284d6a9c1e4e4f6b4729b254be'
-        passphrase = "The quick brown fox jumps over the lazy dog"
-        iv = ffdb.generate_iv()
-
-        ffdb.eprint("Testing aes128")
-        keysize = 16
-        cipher_name, key = ffdb.derive_key(passphrase, keysize)
-        cipher_type = ffdb.get_cipher_type(cipher_name)
-        assert cipher_name == "aes128"
-        assert key == b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1'
-        assert cipher_type == "A"
-
-        ffdb.eprint("Testing aes192")
-        keysize = 24
-        cipher_name, key = ffdb.derive_key(passphrase, keysize)
-        cipher_type = ffdb.get_cipher_type(cipher_name)
-        assert cipher_name == "aes192"
-        assert key == b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1\x86L\x7f=a\xd3\x8cw'
-        assert cipher_type == "B"
-
-        ffdb.eprint("Testing aes256")
-        keysize = 32
-        cipher_name, key = ffdb.derive_key(passphrase, keysize)
-        cipher_type = ffdb.get_cipher_type(cipher_name)
-        assert cipher_name == "aes256"
-        assert key == b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1\x86L\x7f=a\xd3\x8cw\xadc:\x899\xfe^\xfe'
-        assert cipher_type == "C"
+    @pytest.mark.parametrize("keysize, expected_name, expected_key, expected_type", [
+        (16, "aes128", b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1', "A"),
+        (24, "aes192", b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1\x86L\x7f=a\xd3\x8cw', "B"),
+        (32, "aes256", b'c\x05i\xa5\x81c`\x8e(\xa4\xd3CR\xc9\xb0\xf1\x86L\x7f=a\xd3\x8cw'
+                       b'\xadc:\x899\xfe^\xfe', "C")],
+        ids=["aes128", "aes192", "aes256"])
+    def test_key_derivation(self, derived_keys, keysize, expected_name, expected_key,
+                            expected_type):
+        ffdb.eprint("Testing {}".format(expected_name))
+        cipher_name, key = derived_keys[keysize]
+        assert cipher_name == expected_name
+        assert key == expected_key
+        assert ffdb.get_cipher_type(cipher_name) == expected_type
+
+    def test_cipher_mode(self):
+        ffdb.eprint("Testing cipher mode against known answer") #NIST SP 800-38A, CFB8-AES128
+        key = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+        cipher = ffdb.init_cipher(key, bytes(range(16)))
+        encrypted_data = cipher.encrypt(bytes.fromhex('6bc1bee22e409f96e93d7e117393172aae2d'))
+        assert encrypted_data == bytes.fromhex('3b79424c9c0dd436bace9e0ed4586a4f32b9')
 
+    @pytest.mark.parametrize("keysize", [16, 24, 32])
+    def test_ciphers(self, derived_keys, iv, keysize):
         ffdb.eprint("Testing encryption/decryption")
-        for keysize in (16, 24, 32):
-            cipher_name, key = ffdb.derive_key(passphrase, keysize)
+        _, key = derived_keys[keysize]
+
+        cipher = ffdb.init_cipher(key, iv)
+        encrypted_data = cipher.encrypt(DATA_BYTES)
+        compressed_encrypted_data = cipher.encrypt(ffdb.deflate(DATA_BYTES, 9))
+
+        cipher = ffdb.init_cipher(key, iv)
+        decrypted_data = cipher.decrypt(encrypted_data).decode('UTF-8')
+        decrypted_uncompressed_data = ffdb.inflate(cipher.decrypt(compressed_encrypted_data
+                                                                  )).decode('UTF-8')
+        assert decrypted_data == data
+        assert decrypted_uncompressed_data == data
+
+        #random payloads, around and across block boundaries
+        for length in (0, 1, 15, 16, 17, 255, 4097, 65536):
+            payload = os.urandom(length)
+            encrypted_payload = ffdb.init_cipher(key, iv).encrypt(payload)
+            assert len(encrypted_payload) == length
+            assert ffdb.init_cipher(key, iv).decrypt(encrypted_payload) == payload
 
-            cipher = ffdb.init_cipher(key, iv)
-            encrypted_data = cipher.encrypt(data.encode('UTF-8'))
-            compressed_encrypted_data = cipher.encrypt(ffdb.deflate(data.encode('UTF-8'), 9))
 
-            cipher = ffdb.init_cipher(key, iv)
-            decrypted_data = cipher.decrypt(encrypted_data).decode('UTF-8')
-            decrypted_uncompressed_data = ffdb.inflate(cipher.decrypt(compressed_encrypted_data
-                                                                      )).decode('UTF-8')
-            assert decrypted_data == data
-            assert decrypted_uncompressed_data == data
+class TestThroughput:
+    """
+    Regression gates against falling back to slow (e.g. pure python) backends:
+    floors are well below what native implementations reach
+    """
+    def test_deflate_throughput(self):
+        with open(testfile, 'rb') as fh:
+            flatfile = fh.read()
+        repeats = THROUGHPUT_PAYLOADSIZE // len(flatfile) + 1
+        payload = (flatfile * repeats)[:THROUGHPUT_PAYLOADSIZE]
+        assert best_throughput(ffdb.deflate, payload) > DEFLATE_MINTHROUGHPUT
+        assert best_throughput(ffdb.inflate, ffdb.deflate(payload)) > DEFLATE_MINTHROUGHPUT
+
+    def test_cipher_throughput(self, derived_keys, iv):
+        _, key = derived_keys[32]
+        cipher = ffdb.init_cipher(key, iv)
+        payload = os.urandom(THROUGHPUT_PAYLOADSIZE)
+        assert best_throughput(cipher.encrypt, payload) > CIPHER_MINTHROUGHPUT
 
 
 class TestFileIndexing:
@@ -129,26 +230,145 @@ class TestFileIndexing:
         tmpwrite = os.path.join(str(tmp_test_dir), "tmpwrite")
         ffdb.check_iofiles([testfile, testindex_ac], [tmpwrite])
 
-    def test_entry_indexing(self):
+    def test_kernel_readwrite(self, tmp_test_dir, monkeypatch):
+        """
+        Check copy of a piece of file, both in-kernel and with buffered fallback
+        """
+        with open(testfile, 'rb') as fh:
+            expected = fh.read()[100:1100]
+        for kernel_copy_calls in (ffdb.KERNEL_COPY_CALLS, []):
+            monkeypatch.setattr(ffdb, 'KERNEL_COPY_CALLS', kernel_copy_calls)
+            tmpcopy = os.path.join(str(tmp_test_dir), "tmpcopy")
+            with open(testfile, 'rb') as inputfh:
+                with open(tmpcopy, 'wb') as outfh:
+                    copied = ffdb.kernel_readwrite(inputfh.fileno(), outfh.fileno(), 100, 1000)
+            assert copied == 1000
+            with open(tmpcopy, 'rb') as fh:
+                assert fh.read() == expected
+            #writing at given output positions, out of order
+            with open(testfile, 'rb') as inputfh:
+                with open(tmpcopy, 'wb') as outfh:
+                    ffdb.kernel_readwrite(inputfh.fileno(), outfh.fileno(), 600, 500, 500)
+                    ffdb.kernel_readwrite(inputfh.fileno(), outfh.fileno(), 100, 500, 0)
+            with open(tmpcopy, 'rb') as fh:
+                assert fh.read() == expected
+
+    def test_entry_indexing(self, monkeypatch, capfdbinary):
         """
         Check for correct indexing of file
         """
         ffdb.check_iofiles([testfile, testindex_ac], [])
-        indexer_call = ['indexer.py', '-i', '^AC   (.+?);', '-e', '^//$',
-                        '-f', testfile, '-x']
-        indexer_pipe = Popen(indexer_call, stdout=PIPE, stderr=DEVNULL)
-        with open(testindex_ac, 'rb') as fh:
-            for line1, line2 in zip(fh, indexer_pipe.stdout.readlines()):
-                assert line1 == line2
+        run_script('indexer.py', ['-i', '^AC   (.+?);', '-e', '^//$',
+                                  '-f', testfile, '-x'], monkeypatch)
+        output, errors = capfdbinary.readouterr()
+        assert hashlib.sha256(output).digest() == file_digest(testindex_ac), errors.decode()
+
+    def test_index_shifting(self):
+        """
+        Check for correct shifting of positions in index with checksums
+        """
+        offset = 100
+        shifted_lines = ffdb.shift_index(testindex_ac, offset, "-")
+        with open(testindex_ac, 'r') as fh:
+            lines = fh.readlines()
+        assert len(shifted_lines) == len(lines)
+        for line, shifted_line in zip(lines, shifted_lines):
+            columns = line.rstrip("\n").split(ffdb.FIELDSEPARATOR)
+            shifted_columns = shifted_line.rstrip("\n").split(ffdb.FIELDSEPARATOR)
+            assert shifted_line.count("\n") == 1
+            assert shifted_columns[0] == columns[0] #identifier
+            assert shifted_columns[2] == columns[2] #checksum
+            position, length = columns[1].split("-")
+            shifted_position, shifted_length = shifted_columns[1].split("-")
+            assert ffdb.b64_to_int(shifted_position) == ffdb.b64_to_int(position) + offset
+            assert shifted_length == length
 
-    def test_entry_extraction(self):
+    def test_entry_extraction(self, monkeypatch, capfdbinary):
         """
         Check for correct entry extraction
         """
         ffdb.check_iofiles([testfile, testindex_ac], [])
-        extractor_call = ['extractor.py', '-f', testfile, '-i', testindex_ac,
-                          '-l', testlist_ac, '-x']
-        extractor_pipe = Popen(extractor_call, stdout=PIPE, stderr=DEVNULL)
-        with open(testfile, 'rb') as fh:
-            for line1, line2 in zip(fh, extractor_pipe.stdout.readlines()):
-                assert line1 == line2
+        run_script('extractor.py', ['-f', testfile, '-i', testindex_ac,
+                                    '-l', testlist_ac, '-x'], monkeypatch)
+        output, errors = capfdbinary.readouterr()
+        assert hashlib.sha256(output).digest() == file_digest(testfile), errors.decode()
+
+
+class TestFileUpdating:
+    @pytest.mark.parametrize("remover_options", [[], ["-s"]], ids=["search", "bulk"])
+    def test_entry_removal(self, tmp_test_dir, monkeypatch, capfdbinary, remover_options):
+        """
+        Check entries left after removal are extracted as from the original files
+        """
+        workdir = str(tmp_test_dir.mkdir("removal" + "".join(remover_options)))
+        flatfile = os.path.join(workdir, "entries.dat")
+        index = os.path.join(workdir, "entries.idx")
+        removelist = os.path.join(workdir, "removed.list")
+        keptlist = os.path.join(workdir, "kept.list")
+        identifiers = ["ID{:05d}".format(number) for number in range(1500)]
+        #enough deletions for bulk mode, with entries kept before, after and in between
+        removed = set(identifiers[100:1400]) - set(identifiers[500:600:7])
+        kept = [identifier for identifier in identifiers if identifier not in removed]
+        write_flatfile(flatfile, identifiers)
+        with open(removelist, 'w') as fh:
+            fh.writelines("{}\n".format(identifier) for identifier in sorted(removed))
+        with open(keptlist, 'w') as fh:
+            fh.writelines("{}\n".format(identifier) for identifier in kept)
+
+        run_script('indexer.py', ['-i', '^AC   (.+?);', '-e', '^//$', '-f', flatfile, '-x'],
+                   monkeypatch)
+        output, _ = capfdbinary.readouterr()
+        with open(index, 'wb') as fh:
+            fh.write(output)
+        run_script('extractor.py', ['-f', flatfile, '-i', index, '-l', keptlist, '-x'],
+                   monkeypatch)
+        expected, _ = capfdbinary.readouterr()
+
+        run_script('remover.py', ['-f', flatfile, '-i', index, '-l', removelist]
+                   + remover_options, monkeypatch)
+        _, errors = capfdbinary.readouterr()
+        run_script('extractor.py', ['-f', flatfile + ".new", '-i', index + ".new",
+                                    '-l', keptlist, '-x'], monkeypatch)
+        output, _ = capfdbinary.readouterr()
+        assert output == expected, errors.decode()
+        with open(index + ".new") as fh:
+            assert len(fh.readlines()) == len(kept)
+        assert os.path.getsize(flatfile + ".new") == len(expected)
+
+    @pytest.mark.parametrize("merger_options", [[], ["-s"]], ids=["tempfiles", "small"])
+    def test_entry_merging(self, tmp_test_dir, monkeypatch, capfdbinary, merger_options):
+        """
+        Check merged files are the same as indexing the concatenated flatfiles
+        """
+        workdir = str(tmp_test_dir.mkdir("merging" + "".join(merger_options)))
+        identifiers = ["ID{:05d}".format(number) for number in range(1500)]
+        #new identifiers interleaved with the original ones, in two new entries files
+        parts = {"entries": identifiers[::2], "new1": identifiers[1:750:2],
+                 "new2": identifiers[751::2]}
+        for name, part_identifiers in parts.items():
+            flatfile = os.path.join(workdir, name + ".dat")
+            write_flatfile(flatfile, part_identifiers)
+            run_script('indexer.py', ['-i', '^AC   (.+?);', '-e', '^//$', '-f', flatfile, '-x'],
+                       monkeypatch)
+            output, _ = capfdbinary.readouterr()
+            with open(os.path.join(workdir, name + ".idx"), 'wb') as fh:
+                fh.write(output)
+        flatfile, index = [os.path.join(workdir, "entries" + ext) for ext in (".dat", ".idx")]
+        concatenated = os.path.join(workdir, "concatenated.dat")
+        with open(concatenated, 'wb') as fh:
+            for name in parts:
+                with open(os.path.join(workdir, name + ".dat"), 'rb') as partfh:
+                    fh.write(partfh.read())
+        run_script('indexer.py', ['-i', '^AC   (.+?);', '-e', '^//$', '-f', concatenated, '-x'],
+                   monkeypatch)
+        expected, _ = capfdbinary.readouterr()
+
+        run_script('merger.py', ['-c', '-f', flatfile, '-i', index,
+                                 '-e', os.path.join(workdir, "new1.dat"),
+                                 os.path.join(workdir, "new2.dat"),
+                                 '-n', os.path.join(workdir, "new1.idx"),
+                                 os.path.join(workdir, "new2.idx")] + merger_options, monkeypatch)
+        _, errors = capfdbinary.readouterr()
+        with open(index + ".new", 'rb') as fh:
+            assert fh.read() == expected, errors.decode()
+        assert file_digest(flatfile + ".new") == file_digest(concatenated)